@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 
 from ..builder import BBOX_ASSIGNERS
@@ -5,6 +6,8 @@ from ..iou_calculators import build_iou_calculator
 from .assign_result import AssignResult
 from .base_assigner import BaseAssigner
 
+INF = 100000000
+
 
 @BBOX_ASSIGNERS.register_module()
 class ATSSAssigner(BaseAssigner):
@@ -18,15 +21,31 @@ class ATSSAssigner(BaseAssigner):
 
     Args:
         topk (float): number of bbox selected in each level
+        use_numba (bool): Whether to run :meth:`assign` with a numba kernel
+            on CPU instead of with torch ops. Candidates at tied distances,
+            e.g. of gts aligned with the anchor grid, may be picked
+            differently from the torch ops. It does not apply to
+            :meth:`assign_with_vlr_region`. Only the default
+            `BboxOverlaps2D` iou calculator is supported. Default: False.
     """
 
     def __init__(self,
                  topk,
                  iou_calculator=dict(type='BboxOverlaps2D'),
-                 ignore_iof_thr=-1):
+                 ignore_iof_thr=-1,
+                 use_numba=False):
         self.topk = topk
         self.iou_calculator = build_iou_calculator(iou_calculator)
         self.ignore_iof_thr = ignore_iof_thr
+        if use_numba:
+            try:
+                from . import atss_assigner_numba  # noqa: F401
+            except ImportError:
+                raise ImportError('Please run "pip install numba" to use '
+                                  'the numba ATSS assigner.')
+            assert iou_calculator['type'] == 'BboxOverlaps2D', \
+                'the numba ATSS assigner only supports BboxOverlaps2D'
+        self.use_numba = use_numba
 
     # https://github.com/sfzhang15/ATSS/blob/master/atss_core/modeling/rpn/atss/loss.py
 
@@ -54,7 +73,7 @@ class ATSSAssigner(BaseAssigner):
 
         Args:
             bboxes (Tensor): Bounding boxes to be assigned, shape(n, 4).
-            num_level_bboxes (List): num of bboxes in each level
+            num_level_bboxes (List | Tensor): num of bboxes in each level
             gt_bboxes (Tensor): Groundtruth boxes, shape (k, 4).
             gt_bboxes_ignore (Tensor, optional): Ground truth bboxes that are
                 labelled as `ignored`, e.g., crowd boxes in COCO.
@@ -63,45 +82,169 @@ class ATSSAssigner(BaseAssigner):
         Returns:
             :obj:`AssignResult`: The assign result.
         """
-        INF = 100000000
         bboxes = bboxes[:, :4]
+        num_level_bboxes = self._level_sizes(num_level_bboxes)
         num_gt, num_bboxes = gt_bboxes.size(0), bboxes.size(0)
+        if num_gt == 0 or num_bboxes == 0:
+            return self._assign_empty(bboxes, gt_bboxes, gt_labels)
+        if self.use_numba:
+            return self._assign_numba(bboxes, num_level_bboxes, gt_bboxes,
+                                      gt_bboxes_ignore, gt_labels)
 
-        # compute iou between all bbox and gt
-        overlaps = self.iou_calculator(bboxes, gt_bboxes)
+        candidates = self._get_candidates(bboxes, num_level_bboxes, gt_bboxes,
+                                          gt_bboxes_ignore)
+        return self._assign_candidates(bboxes, gt_bboxes, gt_labels,
+                                       candidates)
 
-        # assign 0 by default
-        assigned_gt_inds = overlaps.new_full((num_bboxes, ),
-                                             0,
-                                             dtype=torch.long)
+    def get_vlr_region(self,
+                       bboxes,
+                       num_level_bboxes,
+                       gt_bboxes,
+                       gt_bboxes_ignore=None,
+                       gt_labels=None):
+        """Get the valuable localization region (VLR) of bboxes.
+
+        Steps 1 to 4 are the same as :meth:`assign`, then the bboxes whose
+        DIoU with a gt lies in [0.25 * threshold, threshold) of that gt are
+        in the VLR, and take their max iou with such gts as the region value.
+
+        Args:
+            bboxes (Tensor): Bounding boxes, shape(n, 4).
+            num_level_bboxes (List | Tensor): num of bboxes in each level
+            gt_bboxes (Tensor): Groundtruth boxes, shape (k, 4).
+            gt_bboxes_ignore (Tensor, optional): Ground truth bboxes that are
+                labelled as `ignored`, e.g., crowd boxes in COCO.
+            gt_labels (Tensor, optional): Label of gt_bboxes, shape (k, ).
+
+        Returns:
+            Tensor: The VLR value of each bbox, 0 outside the region,
+                shape (n, ).
+        """
+        bboxes = bboxes[:, :4]
+        num_level_bboxes = self._level_sizes(num_level_bboxes)
+        num_gt, num_bboxes = gt_bboxes.size(0), bboxes.size(0)
+        if num_gt == 0 or num_bboxes == 0:
+            return bboxes.new_zeros((num_bboxes, ))
+
+        candidates = self._get_candidates(bboxes, num_level_bboxes, gt_bboxes,
+                                          gt_bboxes_ignore)
+        return self._vlr_region_candidates(bboxes, gt_bboxes, candidates)
+
+    def assign_with_vlr_region(self,
+                               bboxes,
+                               num_level_bboxes,
+                               gt_bboxes,
+                               gt_bboxes_ignore=None,
+                               gt_labels=None,
+                               bbox_centers=None):
+        """Assign gt to bboxes and get the VLR of bboxes in a single pass.
+
+        The result is the same as calling :meth:`assign` and
+        :meth:`get_vlr_region`, but the iou between all bboxes and gts, the
+        center distances and the candidates of each gt are only computed
+        once and shared by both. As the VLR needs the full iou matrix and the
+        thresholds anyway, the assignment always reuses them with torch ops
+        here, i.e. `use_numba` has no effect on this method.
 
+        Args:
+            bboxes (Tensor): Bounding boxes to be assigned, shape(n, 4).
+            num_level_bboxes (List | Tensor): num of bboxes in each level
+            gt_bboxes (Tensor): Groundtruth boxes, shape (k, 4).
+            gt_bboxes_ignore (Tensor, optional): Ground truth bboxes that are
+                labelled as `ignored`, e.g., crowd boxes in COCO.
+            gt_labels (Tensor, optional): Label of gt_bboxes, shape (k, ).
+            bbox_centers (tuple[Tensor], optional): X and y of the bbox
+                centers, each of shape (n, ). They are computed from bboxes
+                if not given.
+
+        Returns:
+            tuple: The :obj:`AssignResult` and the VLR value of each bbox
+                with shape (n, ).
+        """
+        bboxes = bboxes[:, :4]
+        num_level_bboxes = self._level_sizes(num_level_bboxes)
+        num_gt, num_bboxes = gt_bboxes.size(0), bboxes.size(0)
         if num_gt == 0 or num_bboxes == 0:
-            # No ground truth or boxes, return empty assignment
-            max_overlaps = overlaps.new_zeros((num_bboxes, ))
-            if num_gt == 0:
-                # No truth, assign everything to background
-                assigned_gt_inds[:] = 0
-            if gt_labels is None:
-                assigned_labels = None
-            else:
-                assigned_labels = overlaps.new_full((num_bboxes, ),
-                                                    -1,
-                                                    dtype=torch.long)
-            return AssignResult(
-                num_gt, assigned_gt_inds, max_overlaps, labels=assigned_labels)
+            return (self._assign_empty(bboxes, gt_bboxes, gt_labels),
+                    bboxes.new_zeros((num_bboxes, )))
+
+        candidates = self._get_candidates(bboxes, num_level_bboxes, gt_bboxes,
+                                          gt_bboxes_ignore, bbox_centers)
+        assign_result = self._assign_candidates(bboxes, gt_bboxes, gt_labels,
+                                                candidates)
+        vlr_region = self._vlr_region_candidates(bboxes, gt_bboxes,
+                                                 candidates)
+        return assign_result, vlr_region
+
+    @staticmethod
+    def _level_sizes(num_level_bboxes):
+        """Get the number of bboxes in each level as python ints.
+
+        The levels are sliced and the per-level top-k is sized on the host,
+        so counts given as a tensor, e.g. still on the device they were
+        computed on, are moved to host once here.
+        """
+        if isinstance(num_level_bboxes, torch.Tensor):
+            return num_level_bboxes.tolist()
+        return num_level_bboxes
+
+    def _assign_empty(self, bboxes, gt_bboxes, gt_labels=None):
+        """Assign everything to background when there is no gt or bbox."""
+        num_gt, num_bboxes = gt_bboxes.size(0), bboxes.size(0)
+        assigned_gt_inds = bboxes.new_zeros((num_bboxes, ), dtype=torch.long)
+        max_overlaps = bboxes.new_zeros((num_bboxes, ))
+        if gt_labels is None:
+            assigned_labels = None
+        else:
+            assigned_labels = bboxes.new_full((num_bboxes, ),
+                                              -1,
+                                              dtype=torch.long)
+        return AssignResult(
+            num_gt, assigned_gt_inds, max_overlaps, labels=assigned_labels)
+
+    def _get_candidates(self,
+                        bboxes,
+                        num_level_bboxes,
+                        gt_bboxes,
+                        gt_bboxes_ignore=None,
+                        bbox_centers=None):
+        """Select the candidates of each gt, steps 1 to 4 of :meth:`assign`.
+
+        Returns:
+            tuple: Shared by :meth:`_assign_candidates` and
+                :meth:`_vlr_region_candidates`.
+                overlaps (Tensor): IoU between all bboxes and gts with
+                    shape (n, k).
+                bboxes_cx (Tensor): X of bbox centers with shape (n, ).
+                bboxes_cy (Tensor): Y of bbox centers with shape (n, ).
+                ignore_idxs (Tensor | None): Whether each bbox is ignored.
+                candidate_idxs (Tensor): Indices of the candidate bboxes of
+                    each gt with shape (num_candidates, k).
+                candidate_overlaps (Tensor): IoU of the candidates with shape
+                    (num_candidates, k).
+                overlaps_thr_per_gt (Tensor): IoU threshold of each gt with
+                    shape (k, ).
+        """
+        num_gt = gt_bboxes.size(0)
+        # compute iou between all bbox and gt
+        overlaps = self.iou_calculator(bboxes, gt_bboxes)
 
         # compute center distance between all bbox and gt
         gt_cx = (gt_bboxes[:, 0] + gt_bboxes[:, 2]) / 2.0
         gt_cy = (gt_bboxes[:, 1] + gt_bboxes[:, 3]) / 2.0
         gt_points = torch.stack((gt_cx, gt_cy), dim=1)
 
-        bboxes_cx = (bboxes[:, 0] + bboxes[:, 2]) / 2.0
-        bboxes_cy = (bboxes[:, 1] + bboxes[:, 3]) / 2.0
+        if bbox_centers is None:
+            bboxes_cx = (bboxes[:, 0] + bboxes[:, 2]) / 2.0
+            bboxes_cy = (bboxes[:, 1] + bboxes[:, 3]) / 2.0
+        else:
+            bboxes_cx, bboxes_cy = bbox_centers
         bboxes_points = torch.stack((bboxes_cx, bboxes_cy), dim=1)
 
         distances = (bboxes_points[:, None, :] -
                      gt_points[None, :, :]).pow(2).sum(-1).sqrt()
 
+        ignore_idxs = None
         if (self.ignore_iof_thr > 0 and gt_bboxes_ignore is not None
                 and gt_bboxes_ignore.numel() > 0 and bboxes.numel() > 0):
             ignore_overlaps = self.iou_calculator(
@@ -109,7 +252,6 @@ class ATSSAssigner(BaseAssigner):
             ignore_max_overlaps, _ = ignore_overlaps.max(dim=1)
             ignore_idxs = ignore_max_overlaps > self.ignore_iof_thr
             distances[ignore_idxs, :] = INF
-            assigned_gt_inds[ignore_idxs] = -1
 
         # Selecting candidates based on the center distance
         candidate_idxs = []
@@ -132,12 +274,28 @@ class ATSSAssigner(BaseAssigner):
         overlaps_mean_per_gt = candidate_overlaps.mean(0)
         overlaps_std_per_gt = candidate_overlaps.std(0)
         overlaps_thr_per_gt = overlaps_mean_per_gt + overlaps_std_per_gt
+        return (overlaps, bboxes_cx, bboxes_cy, ignore_idxs, candidate_idxs,
+                candidate_overlaps, overlaps_thr_per_gt)
+
+    def _assign_candidates(self, bboxes, gt_bboxes, gt_labels, candidates):
+        """Assign gt to bboxes from the candidates, steps 5 and 6 of
+        :meth:`assign`."""
+        (overlaps, bboxes_cx, bboxes_cy, ignore_idxs, candidate_idxs,
+         candidate_overlaps, overlaps_thr_per_gt) = candidates
+        num_gt, num_bboxes = gt_bboxes.size(0), bboxes.size(0)
+
+        # assign 0 by default
+        assigned_gt_inds = overlaps.new_full((num_bboxes, ),
+                                             0,
+                                             dtype=torch.long)
+        if ignore_idxs is not None:
+            assigned_gt_inds[ignore_idxs] = -1
 
         is_pos = candidate_overlaps >= overlaps_thr_per_gt[None, :]
 
         # limit the positive sample's center in gt
-        for gt_idx in range(num_gt):
-            candidate_idxs[:, gt_idx] += gt_idx * num_bboxes
+        candidate_idxs = candidate_idxs + torch.arange(
+            num_gt, device=candidate_idxs.device) * num_bboxes
         ep_bboxes_cx = bboxes_cx.view(1, -1).expand(
             num_gt, num_bboxes).contiguous().view(-1)
         ep_bboxes_cy = bboxes_cy.view(1, -1).expand(
@@ -163,9 +321,6 @@ class ATSSAssigner(BaseAssigner):
         overlaps_inf = overlaps_inf.view(num_gt, -1).t()
         max_overlaps, argmax_overlaps = overlaps_inf.max(dim=1)
 
-        overlaps_inf = torch.full_like(overlaps,
-                                       -INF).t().contiguous().view(-1)
-        overlaps_inf = overlaps_inf.view(num_gt, -1).t()
         assigned_gt_inds[
             max_overlaps != -INF] = argmax_overlaps[max_overlaps != -INF] + 1
         if gt_labels is not None:
@@ -180,119 +335,55 @@ class ATSSAssigner(BaseAssigner):
         return AssignResult(
             num_gt, assigned_gt_inds, max_overlaps, labels=assigned_labels)
 
-    def get_vlr_region(self,
-                       bboxes,
-                       num_level_bboxes,
-                       gt_bboxes,
-                       gt_bboxes_ignore=None,
-                       gt_labels=None):
-
-        INF = 100000000
-        bboxes = bboxes[:, :4]
-        num_gt, num_bboxes = gt_bboxes.size(0), bboxes.size(0)
-
-        # compute iou between all bbox and gt
-
-        overlaps = self.iou_calculator(bboxes, gt_bboxes)
+    def _vlr_region_candidates(self, bboxes, gt_bboxes, candidates):
+        """Get the VLR of bboxes from the candidates, see
+        :meth:`get_vlr_region`."""
+        overlaps, overlaps_thr_per_gt = candidates[0], candidates[-1]
         diou = self.iou_calculator(bboxes, gt_bboxes, mode='diou')
-        # assign 0 by default
-        assigned_gt_inds = overlaps.new_full((num_bboxes, ),
-                                             0,
-                                             dtype=torch.long)
-        vlr_region_iou = (assigned_gt_inds + 0).float()
-        if num_gt == 0 or num_bboxes == 0:
-            # No ground truth or boxes, return empty assignment
-            max_overlaps = overlaps.new_zeros((num_bboxes, ))
-            if num_gt == 0:
-                # No truth, assign everything to background
-                assigned_gt_inds[:] = 0
-            if gt_labels is None:
-                assigned_labels = None
-            else:
-                assigned_labels = overlaps.new_full((num_bboxes, ),
-                                                    -1,
-                                                    dtype=torch.long)
-            return AssignResult(
-                num_gt, assigned_gt_inds, max_overlaps, labels=assigned_labels)
-
-        # compute center distance between all bbox and gt
-        gt_cx = (gt_bboxes[:, 0] + gt_bboxes[:, 2]) / 2.0
-        gt_cy = (gt_bboxes[:, 1] + gt_bboxes[:, 3]) / 2.0
-        gt_points = torch.stack((gt_cx, gt_cy), dim=1)
-
-        bboxes_cx = (bboxes[:, 0] + bboxes[:, 2]) / 2.0
-        bboxes_cy = (bboxes[:, 1] + bboxes[:, 3]) / 2.0
-        bboxes_points = torch.stack((bboxes_cx, bboxes_cy), dim=1)
-
-        distances = (bboxes_points[:, None, :] -
-                     gt_points[None, :, :]).pow(2).sum(-1).sqrt()
-
+        # every bbox of every level is a VLR candidate of each gt, so the
+        # bounds are checked on the whole matrix
+        is_pos = (diou < overlaps_thr_per_gt[None, :]) & (
+            diou >= 0.25 * overlaps_thr_per_gt[None, :])
+        max_overlaps, _ = torch.where(
+            is_pos, overlaps, overlaps.new_full((1, ), -INF)).max(dim=1)
+        return torch.where(max_overlaps != -INF, max_overlaps,
+                           max_overlaps.new_zeros((1, )))
+
+    def _assign_numba(self,
+                      bboxes,
+                      num_level_bboxes,
+                      gt_bboxes,
+                      gt_bboxes_ignore=None,
+                      gt_labels=None):
+        """Assign gt to bboxes with the numba kernel, see :meth:`assign`."""
+        from .atss_assigner_numba import atss_assign_numba
+        ignore_flags = bboxes.new_zeros((bboxes.size(0), ), dtype=torch.bool)
         if (self.ignore_iof_thr > 0 and gt_bboxes_ignore is not None
-                and gt_bboxes_ignore.numel() > 0 and bboxes.numel() > 0):
+                and gt_bboxes_ignore.numel() > 0):
             ignore_overlaps = self.iou_calculator(
                 bboxes, gt_bboxes_ignore, mode='iof')
             ignore_max_overlaps, _ = ignore_overlaps.max(dim=1)
-            ignore_idxs = ignore_max_overlaps > self.ignore_iof_thr
-            distances[ignore_idxs, :] = INF
-            assigned_gt_inds[ignore_idxs] = -1
+            ignore_flags = ignore_max_overlaps > self.ignore_iof_thr
 
-        # Selecting candidates based on the center distance
-        candidate_idxs = []
-        candidate_idxs_t = []
+        assigned_gt_inds, max_overlaps = atss_assign_numba(
+            np.ascontiguousarray(bboxes.detach().float().cpu().numpy()),
+            np.ascontiguousarray(gt_bboxes.detach().float().cpu().numpy()),
+            np.array(num_level_bboxes, dtype=np.int64), self.topk,
+            ignore_flags.cpu().numpy())
+        assigned_gt_inds = torch.from_numpy(assigned_gt_inds).to(bboxes.device)
+        max_overlaps = torch.from_numpy(max_overlaps).to(bboxes.device)
 
-        start_idx = 0
-        for level, bboxes_per_level in enumerate(num_level_bboxes):
-            # on each pyramid level, for each gt,
-            # select k bbox whose center are closest to the gt center
-            end_idx = start_idx + bboxes_per_level
-            distances_per_level = distances[start_idx:end_idx, :]
-            selectable_t = min(self.topk, bboxes_per_level)
-            selectable_k = min(bboxes_per_level, bboxes_per_level)
-            _, topk_idxs_per_level = distances_per_level.topk(
-                selectable_k, dim=0, largest=False)
-            _, topt_idxs_per_level = distances_per_level.topk(
-                selectable_t, dim=0, largest=False)
-            candidate_idxs.append(topk_idxs_per_level + start_idx)
-            candidate_idxs_t.append(topt_idxs_per_level + start_idx)
-            start_idx = end_idx
-        candidate_idxs = torch.cat(candidate_idxs, dim=0)
-        candidate_idxs_t = torch.cat(candidate_idxs_t, dim=0)
-
-        # get corresponding iou for the these candidates, and compute the
-        # mean and std, set mean + std as the iou threshold
-        candidate_overlaps_t = overlaps[candidate_idxs_t, torch.arange(num_gt)]
-        # t_overlaps = overlaps[candidate_idxs_t, torch.arange(num_gt)]
-
-        t_diou = diou[candidate_idxs, torch.arange(num_gt)]
-        overlaps_mean_per_gt = candidate_overlaps_t.mean(0)
-        overlaps_std_per_gt = candidate_overlaps_t.std(0)
-        overlaps_thr_per_gt = overlaps_mean_per_gt + overlaps_std_per_gt
-
-        #is_pos = (candidate_overlaps < overlaps_thr_per_gt[None, :]) & (candidate_overlaps >= 0.5*overlaps_thr_per_gt[None, :])
-        is_pos = (t_diou < overlaps_thr_per_gt[None, :]) & (
-            t_diou >= 0.25 * overlaps_thr_per_gt[None, :])
-
-        # limit the positive sample's center in gt
-        for gt_idx in range(num_gt):
-            candidate_idxs[:, gt_idx] += gt_idx * num_bboxes
-
-        candidate_idxs = candidate_idxs.view(-1)
-
-        overlaps_inf = torch.full_like(overlaps,
-                                       -INF).t().contiguous().view(-1)
-        index = candidate_idxs.view(-1)[is_pos.view(-1)]
-
-        overlaps_inf[index] = overlaps.t().contiguous().view(-1)[index]
-        overlaps_inf = overlaps_inf.view(num_gt, -1).t()
-        max_overlaps, argmax_overlaps = overlaps_inf.max(dim=1)
-
-        overlaps_inf = torch.full_like(overlaps,
-                                       -INF).t().contiguous().view(-1)
-        overlaps_inf = overlaps_inf.view(num_gt, -1).t()
-        assigned_gt_inds[
-            max_overlaps != -INF] = argmax_overlaps[max_overlaps != -INF] + 1
-
-        vlr_region_iou[
-            max_overlaps != -INF] = max_overlaps[max_overlaps != -INF] + 0
-
-        return vlr_region_iou
+        if gt_labels is not None:
+            assigned_labels = assigned_gt_inds.new_full((bboxes.size(0), ), -1)
+            pos_inds = torch.nonzero(
+                assigned_gt_inds > 0, as_tuple=False).squeeze(1)
+            if pos_inds.numel() > 0:
+                assigned_labels[pos_inds] = gt_labels[
+                    assigned_gt_inds[pos_inds] - 1]
+        else:
+            assigned_labels = None
+        return AssignResult(
+            gt_bboxes.size(0),
+            assigned_gt_inds,
+            max_overlaps,
+            labels=assigned_labels)
@@ -0,0 +1,123 @@
+"""Numba kernel of :class:`ATSSAssigner`, only imported with `use_numba`."""
+import numba
+import numpy as np
+
+from .atss_assigner import INF
+
+
+@numba.njit(parallel=True, cache=True)
+def atss_assign_numba(bboxes, gt_bboxes, num_level_bboxes, topk,
+                      ignore_flags):
+    """ATSS assignment over contiguous arrays, one gt per parallel loop.
+
+    Candidates at the same distance from a gt center are ordered by a stable
+    sort here, while `torch.topk` in :meth:`ATSSAssigner.assign` does not
+    specify their order. When such ties cross the top-k boundary, e.g. for
+    gts aligned with the anchor grid, the two paths may pick different
+    candidates and thus assign different gts.
+
+    Args:
+        bboxes (ndarray): Bounding boxes, shape (n, 4), float32.
+        gt_bboxes (ndarray): Groundtruth boxes, shape (k, 4), float32.
+        num_level_bboxes (ndarray): Num of bboxes in each level, int64.
+        topk (int): Number of bbox selected in each level.
+        ignore_flags (ndarray): Whether each bbox overlaps an ignored gt,
+            shape (n, ), bool.
+
+    Returns:
+        tuple[ndarray]: 1-based assigned gt index (0 for negative, -1 for
+            ignored) and max overlap of each bbox, both of shape (n, ).
+    """
+    num_bboxes = bboxes.shape[0]
+    num_gt = gt_bboxes.shape[0]
+    num_levels = num_level_bboxes.shape[0]
+    num_candidates = 0
+    for level in range(num_levels):
+        num_candidates += min(topk, num_level_bboxes[level])
+
+    bboxes_cx = (bboxes[:, 0] + bboxes[:, 2]) / 2.0
+    bboxes_cy = (bboxes[:, 1] + bboxes[:, 3]) / 2.0
+    bboxes_area = (bboxes[:, 2] - bboxes[:, 0]) * (
+        bboxes[:, 3] - bboxes[:, 1])
+
+    candidate_idxs = np.empty((num_gt, num_candidates), dtype=np.int64)
+    candidate_overlaps = np.empty((num_gt, num_candidates),
+                                  dtype=np.float32)
+    is_pos = np.zeros((num_gt, num_candidates), dtype=np.bool_)
+    for gt_idx in numba.prange(num_gt):
+        gt_x1 = gt_bboxes[gt_idx, 0]
+        gt_y1 = gt_bboxes[gt_idx, 1]
+        gt_x2 = gt_bboxes[gt_idx, 2]
+        gt_y2 = gt_bboxes[gt_idx, 3]
+        gt_cx = (gt_x1 + gt_x2) / 2.0
+        gt_cy = (gt_y1 + gt_y2) / 2.0
+        gt_area = (gt_x2 - gt_x1) * (gt_y2 - gt_y1)
+
+        # on each pyramid level select k bbox whose center are closest
+        # to the gt center
+        start_idx = 0
+        col = 0
+        for level in range(num_levels):
+            bboxes_per_level = num_level_bboxes[level]
+            distances = np.empty(bboxes_per_level, dtype=np.float32)
+            for i in range(bboxes_per_level):
+                if ignore_flags[start_idx + i]:
+                    distances[i] = INF
+                else:
+                    dx = bboxes_cx[start_idx + i] - gt_cx
+                    dy = bboxes_cy[start_idx + i] - gt_cy
+                    distances[i] = np.sqrt(dx * dx + dy * dy)
+            order = np.argsort(distances, kind='mergesort')
+            for i in range(min(topk, bboxes_per_level)):
+                candidate_idxs[gt_idx, col] = start_idx + order[i]
+                col += 1
+            start_idx += bboxes_per_level
+
+        # iou of the candidates, the mean + std of which is the threshold
+        overlaps_sum = 0.0
+        for col in range(num_candidates):
+            idx = candidate_idxs[gt_idx, col]
+            w = min(bboxes[idx, 2], gt_x2) - max(bboxes[idx, 0], gt_x1)
+            h = min(bboxes[idx, 3], gt_y2) - max(bboxes[idx, 1], gt_y1)
+            overlap = max(w, 0.0) * max(h, 0.0)
+            union = max(bboxes_area[idx] + gt_area - overlap, 1e-6)
+            candidate_overlaps[gt_idx, col] = overlap / union
+            overlaps_sum += candidate_overlaps[gt_idx, col]
+        overlaps_mean = overlaps_sum / num_candidates
+        overlaps_var = 0.0
+        for col in range(num_candidates):
+            diff = candidate_overlaps[gt_idx, col] - overlaps_mean
+            overlaps_var += diff * diff
+        # unbiased std as torch.std, which is nan for a single candidate
+        if num_candidates > 1:
+            overlaps_thr = overlaps_mean + np.sqrt(
+                overlaps_var / (num_candidates - 1))
+        else:
+            overlaps_thr = np.nan
+
+        # limit the positive sample's center in gt
+        for col in range(num_candidates):
+            idx = candidate_idxs[gt_idx, col]
+            min_dist = min(bboxes_cx[idx] - gt_x1,
+                           bboxes_cy[idx] - gt_y1,
+                           gt_x2 - bboxes_cx[idx],
+                           gt_y2 - bboxes_cy[idx])
+            is_pos[gt_idx, col] = (
+                candidate_overlaps[gt_idx, col] >= overlaps_thr
+                and min_dist > 0.01)
+
+    # if an anchor box is assigned to multiple gts,
+    # the one with the highest IoU will be selected.
+    assigned_gt_inds = np.zeros(num_bboxes, dtype=np.int64)
+    max_overlaps = np.full(num_bboxes, -INF, dtype=np.float32)
+    for i in range(num_bboxes):
+        if ignore_flags[i]:
+            assigned_gt_inds[i] = -1
+    for gt_idx in range(num_gt):
+        for col in range(num_candidates):
+            idx = candidate_idxs[gt_idx, col]
+            overlap = candidate_overlaps[gt_idx, col]
+            if is_pos[gt_idx, col] and overlap > max_overlaps[idx]:
+                max_overlaps[idx] = overlap
+                assigned_gt_inds[idx] = gt_idx + 1
+    return assigned_gt_inds, max_overlaps
@@ -1,3 +1,5 @@
+import inspect
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -5,13 +7,140 @@ import torch.nn.functional as F
 from mmcv.cnn import ConvModule, Scale, bias_init_with_prob, normal_init
 from mmcv.runner import force_fp32
 import numpy as np
-from mmdet.core import (anchor_inside_flags, bbox2distance, bbox_overlaps,
-                        build_assigner, build_sampler, distance2bbox,
+from mmdet.core import (anchor_inside_flags, bbox2distance, build_assigner,
+                        build_sampler, distance2bbox,
                         images_to_levels, multi_apply, multiclass_nms,
                         reduce_mean, unmap)
 from ..builder import HEADS, build_loss
 from .anchor_head import AnchorHead
 
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+
+@torch.jit.script
+def integral_forward(x: torch.Tensor, project: torch.Tensor,
+                     reg_max: int) -> torch.Tensor:
+    """Compute the integral result of a distribution in one scripted graph,
+    so that the softmax and the projection run with less Python dispatch
+    overhead.
+
+    Args:
+        x (Tensor): Distribution logits, shape (N, 4*(n+1)), n is reg_max.
+        project (Tensor): The discrete set {0, 1, 2, ..., reg_max}.
+        reg_max (int): The maximal value of the discrete set.
+
+    Returns:
+        Tensor: Distance offsets in four directions, shape (N, 4).
+    """
+    x = F.softmax(x.reshape(-1, reg_max + 1), dim=1)
+    return torch.matmul(x, project).reshape(-1, 4)
+
+
+@torch.jit.script
+def aligned_iou(bboxes1: torch.Tensor, bboxes2: torch.Tensor,
+                eps: float = 1e-6) -> torch.Tensor:
+    """Compute the IoU between aligned pairs of boxes in a scripted graph,
+    so that the elementwise chain of `bbox_overlaps(..., is_aligned=True)`
+    is fused into fewer kernels.
+
+    Args:
+        bboxes1 (Tensor): Boxes with shape (N, 4), "xyxy" format.
+        bboxes2 (Tensor): Boxes with shape (N, 4), "xyxy" format.
+        eps (float): Lower bound of the union area.
+
+    Returns:
+        Tensor: IoU of each pair of boxes, shape (N, ).
+    """
+    lt = torch.max(bboxes1[:, :2], bboxes2[:, :2])
+    rb = torch.min(bboxes1[:, 2:], bboxes2[:, 2:])
+    wh = (rb - lt).clamp(min=0)
+    overlap = wh[:, 0] * wh[:, 1]
+    area1 = (bboxes1[:, 2] - bboxes1[:, 0]) * (bboxes1[:, 3] - bboxes1[:, 1])
+    area2 = (bboxes2[:, 2] - bboxes2[:, 0]) * (bboxes2[:, 3] - bboxes2[:, 1])
+    union = (area1 + area2 - overlap).clamp(min=eps)
+    return overlap / union
+
+
+@torch.jit.script
+def count_per_level(inside_flags: torch.Tensor, level_ids: torch.Tensor,
+                    num_levels: int) -> torch.Tensor:
+    """Count the set flags of each scale level in a scripted graph.
+
+    Args:
+        inside_flags (Tensor): Flags of all anchors, shape (num_anchors, ) or
+            (num_imgs, num_anchors).
+        level_ids (Tensor): Level index of every anchor, shape
+            (num_anchors, ).
+        num_levels (int): Number of scale levels.
+
+    Returns:
+        Tensor: Number of set flags of each level, shape (num_levels, ) or
+            (num_imgs, num_levels).
+    """
+    # scatter_add_ rather than bincount on the level ids of the inside
+    # anchors: the CUDA bincount reads the max id back to the host to size
+    # its output and the gather of the inside ids needs a nonzero, both of
+    # which are extra syncs, and bincount does not batch over images
+    shape = list(inside_flags.shape[:-1])
+    shape.append(num_levels)
+    counts = torch.zeros(shape, dtype=torch.long, device=inside_flags.device)
+    return counts.scatter_add_(-1, level_ids.expand_as(inside_flags),
+                               inside_flags.long())
+
+
+if triton is not None:
+
+    @triton.jit
+    def _softmax_expect_kernel(x_ptr, out_ptr, num_rows, R: tl.constexpr,
+                               BLOCK_R: tl.constexpr, BLOCK_M: tl.constexpr):
+        """Softmax of BLOCK_M rows of length R and their expectation over
+        {0, 1, ..., R - 1}, computed in a single pass."""
+        rows = tl.program_id(0) * BLOCK_M + tl.arange(0, BLOCK_M)
+        cols = tl.arange(0, BLOCK_R)
+        col_mask = cols[None, :] < R
+        x = tl.load(
+            x_ptr + rows[:, None] * R + cols[None, :],
+            mask=(rows[:, None] < num_rows) & col_mask,
+            other=0.).to(tl.float32)
+        x = tl.where(col_mask, x, -float('inf'))
+        x = tl.exp(x - tl.max(x, axis=1)[:, None])
+        out = tl.sum(x * cols[None, :].to(tl.float32), axis=1) / tl.sum(
+            x, axis=1)
+        tl.store(
+            out_ptr + rows,
+            out.to(out_ptr.dtype.element_ty),
+            mask=rows < num_rows)
+
+
+def integral_forward_triton(x, reg_max):
+    """Same as :func:`integral_forward` with project {0, 1, ..., reg_max},
+    but fused into one triton kernel that reads the logits only once.
+
+    Args:
+        x (Tensor): Distribution logits on CUDA, shape (N, 4*(n+1)), n is
+            reg_max.
+        reg_max (int): The maximal value of the discrete set.
+
+    Returns:
+        Tensor: Distance offsets in four directions, shape (N, 4).
+    """
+    x = x.reshape(-1, reg_max + 1).contiguous()
+    out = x.new_empty(x.size(0))
+    block_m = 64
+    grid = (triton.cdiv(x.size(0), block_m), )
+    _softmax_expect_kernel[grid](
+        x,
+        out,
+        x.size(0),
+        R=reg_max + 1,
+        BLOCK_R=triton.next_power_of_2(reg_max + 1),
+        BLOCK_M=block_m)
+    return out.reshape(-1, 4)
+
 
 class Integral(nn.Module):
     """A fixed layer for calculating integral result from distribution.
@@ -24,13 +153,23 @@ class Integral(nn.Module):
         reg_max (int): The maximal value of the discrete set. Default: 16. You
             may want to reset it according to your new dataset or related
             settings.
+        use_triton (bool): Whether to decode CUDA inputs that do not require
+            grad, e.g. at inference or of the teacher in distillation, with
+            a fused triton kernel. Default: False.
     """
 
-    def __init__(self, reg_max=16):
+    def __init__(self, reg_max=16, use_triton=False):
         super(Integral, self).__init__()
         self.reg_max = reg_max
+        if use_triton and triton is None:
+            raise ImportError('Please run "pip install triton" to use the '
+                              'triton integral kernel.')
+        self.use_triton = use_triton
         self.register_buffer('project',
                              torch.linspace(0, self.reg_max, self.reg_max + 1))
+        # project cast to any other (device, dtype) seen in forward, e.g. the
+        # half precision copies used in mixed precision training
+        self._proj_cache = {}
 
     def forward(self, x):
         """Forward feature from the regression head to get integral result of
@@ -44,9 +183,18 @@ class Integral(nn.Module):
             x (Tensor): Integral result of box locations, i.e., distance
                 offsets from the box center in four directions, shape (N, 4).
         """
-        x = F.softmax(x.reshape(-1, self.reg_max + 1), dim=1)
-        x = F.linear(x, self.project.type_as(x)).reshape(-1, 4)
-        return x
+        if self.use_triton and x.is_cuda and not x.requires_grad:
+            # decode without autograd, where project is always
+            # {0, ..., reg_max} and can be folded into the kernel
+            return integral_forward_triton(x, self.reg_max)
+        project = self.project
+        if x.device != project.device or x.dtype != project.dtype:
+            key = (x.device, x.dtype)
+            project = self._proj_cache.get(key)
+            if project is None:
+                project = self.project.to(device=x.device, dtype=x.dtype)
+                self._proj_cache[key] = project
+        return integral_forward(x, project, self.reg_max)
 
 
 @HEADS.register_module()
@@ -75,6 +223,16 @@ class GFLHead(AnchorHead):
         loss_qfl (dict): Config of Quality Focal Loss (QFL).
         reg_max (int): Max value of integral set :math: `{0, ..., reg_max}`
             in QFL setting. Default: 16.
+        tower_dtype (str | None): If set, e.g. 'bfloat16' or 'float16', the
+            conv towers of CUDA inputs run under autocast with this dtype and
+            their outputs are cast back to float32. Needs torch>=1.10, and a
+            GPU with bfloat16 support for 'bfloat16'. Default: None.
+        level_streams (bool): Whether to run the scale levels of CUDA inputs
+            on separate CUDA streams so that their kernels can overlap.
+            Default: False.
+        triton_integral (bool): Whether to decode the box distributions
+            that do not require grad with a fused triton kernel, see
+            :class:`Integral`. Default: False.
     Example:
         >>> self = GFLHead(11, 7)
         >>> feats = [torch.rand(1, 7, s, s) for s in [4, 8, 16, 32, 64]]
@@ -90,11 +248,31 @@ class GFLHead(AnchorHead):
                  norm_cfg=dict(type='GN', num_groups=32, requires_grad=True),
                  loss_dfl=dict(type='DistributionFocalLoss', loss_weight=0.25),
                  reg_max=16,
+                 tower_dtype=None,
+                 level_streams=False,
+                 triton_integral=False,
                  **kwargs):
         self.stacked_convs = stacked_convs
         self.conv_cfg = conv_cfg
         self.norm_cfg = norm_cfg
         self.reg_max = reg_max
+        self.tower_dtype = getattr(torch, tower_dtype) if tower_dtype else None
+        if self.tower_dtype is not None:
+            # torch.cuda.amp only exists from torch 1.6 and its autocast
+            # takes a dtype from torch 1.10
+            autocast = getattr(getattr(torch.cuda, 'amp', None), 'autocast',
+                               None)
+            if (autocast is None
+                    or 'dtype' not in inspect.signature(autocast).parameters):
+                raise RuntimeError(
+                    f'tower_dtype={tower_dtype} needs torch>=1.10 for '
+                    f'autocast with a dtype, got torch {torch.__version__}')
+            if (self.tower_dtype == torch.bfloat16
+                    and torch.cuda.is_available()
+                    and not torch.cuda.is_bf16_supported()):
+                raise RuntimeError(
+                    'tower_dtype=bfloat16 is not supported by the GPU')
+        self.level_streams = level_streams
         super(GFLHead, self).__init__(num_classes, in_channels, **kwargs)
 
         self.sampling = False
@@ -104,8 +282,14 @@ class GFLHead(AnchorHead):
             sampler_cfg = dict(type='PseudoSampler')
             self.sampler = build_sampler(sampler_cfg, context=self)
 
-        self.integral = Integral(self.reg_max)
+        self.integral = Integral(self.reg_max, use_triton=triton_integral)
         self.loss_dfl = build_loss(loss_dfl)
+        # flat quality score target buffers reused across iterations, one
+        # per (device, dtype)
+        self._score_buf = {}
+        # scale level index of every anchor, cached for the last anchor layout
+        self._level_ids = None
+        self._level_ids_key = None
 
     def _init_layers(self):
         """Initialize layers of the head."""
@@ -139,6 +323,8 @@ class GFLHead(AnchorHead):
             self.feat_channels, 4 * (self.reg_max + 1), 3, padding=1)
         self.scales = nn.ModuleList(
             [Scale(1.0) for _ in self.anchor_generator.strides])
+        # one CUDA stream per scale level for each device, created lazily
+        self._streams = {}
 
     def init_weights(self):
         """Initialize weights of the head."""
@@ -166,7 +352,31 @@ class GFLHead(AnchorHead):
                     scale levels, each is a 4D-tensor, the channel number is
                     4*(n+1), n is max value of integral set.
         """
-        return multi_apply(self.forward_single, feats, self.scales)
+        if not (self.level_streams and feats[0].is_cuda):
+            return multi_apply(self.forward_single, feats, self.scales)
+
+        device = feats[0].device
+        if device not in self._streams:
+            self._streams[device] = [
+                torch.cuda.Stream(device=device) for _ in self.scales
+            ]
+        main_stream = torch.cuda.current_stream(device)
+        cls_scores, bbox_preds = [], []
+        for x, scale, stream in zip(feats, self.scales,
+                                    self._streams[device]):
+            stream.wait_stream(main_stream)
+            with torch.cuda.stream(stream):
+                # x is allocated on the main stream but consumed here
+                x.record_stream(stream)
+                cls_score, bbox_pred = self.forward_single(x, scale)
+            cls_scores.append(cls_score)
+            bbox_preds.append(bbox_pred)
+        for stream, cls_score, bbox_pred in zip(self._streams[device],
+                                                cls_scores, bbox_preds):
+            main_stream.wait_stream(stream)
+            cls_score.record_stream(main_stream)
+            bbox_pred.record_stream(main_stream)
+        return cls_scores, bbox_preds
 
     def forward_single(self, x, scale):
         """Forward feature of a single scale level.
@@ -184,15 +394,32 @@ class GFLHead(AnchorHead):
                     level, the channel number is 4*(n+1), n is max value of
                     integral set.
         """
+        # cuDNN only picks its NHWC kernels when the weights are channels
+        # last too, so convert the model to that format once before wrapping
+        # it in (Distributed)DataParallel; weights are never changed here
+        if x.is_cuda:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.tower_dtype is not None and x.is_cuda:
+            # only the convs run in reduced precision, the integral decode
+            # and the losses keep working on float32 outputs
+            with torch.cuda.amp.autocast(dtype=self.tower_dtype):
+                cls_score, bbox_pred = self._forward_towers(x)
+            cls_score = cls_score.float()
+            bbox_pred = bbox_pred.float()
+        else:
+            cls_score, bbox_pred = self._forward_towers(x)
+        bbox_pred = scale(bbox_pred).float()
+        return cls_score, bbox_pred
+
+    def _forward_towers(self, x):
+        """Run the cls and reg conv towers of a single scale level."""
         cls_feat = x
         reg_feat = x
         for cls_conv in self.cls_convs:
             cls_feat = cls_conv(cls_feat)
         for reg_conv in self.reg_convs:
             reg_feat = reg_conv(reg_feat)
-        cls_score = self.gfl_cls(cls_feat)
-        bbox_pred = scale(self.gfl_reg(reg_feat)).float()
-        return cls_score, bbox_pred
+        return self.gfl_cls(cls_feat), self.gfl_reg(reg_feat)
 
     def anchor_center(self, anchors):
         """Get anchor centers from anchors.
@@ -203,43 +430,95 @@ class GFLHead(AnchorHead):
         Returns:
             Tensor: Anchor centers with shape (N, 2), "xy" format.
         """
-        anchors_cx = (anchors[..., 2] + anchors[..., 0]) / 2
-        anchors_cy = (anchors[..., 3] + anchors[..., 1]) / 2
-        return torch.stack([anchors_cx, anchors_cy], dim=-1)
+        return (anchors[..., :2] + anchors[..., 2:4]).mul_(0.5)
+
+    def _distance2bbox_out(self, points, distance, out=None):
+        """Decode distance prediction to bounding box like `distance2bbox`
+        without `max_shape`, writing both corners into one preallocated
+        tensor instead of stacking the four coordinates.
+
+        Args:
+            points (Tensor): Shape (N, 2).
+            distance (Tensor): Distance from the given point to 4
+                boundaries (left, top, right, bottom), shape (N, 4).
+            out (Tensor, optional): Output tensor with shape (N, 4). A new
+                one is allocated if not given.
+
+        Returns:
+            Tensor: Boxes with shape (N, 4), "xyxy" format.
+        """
+        if out is None:
+            out = distance.new_empty(distance.shape)
+        out[..., :2] = points - distance[..., :2]
+        out[..., 2:] = points + distance[..., 2:]
+        return out
+
+    def _get_score_buffer(self, labels, dtype):
+        """Get a zeroed quality score target shaped like ``labels``.
+
+        The memory comes from a flat buffer cached per device and dtype, which
+        only grows when a larger input arrives, so multi-scale training does
+        not keep one buffer for every input shape. The score is a non-grad
+        target that the QFL loss only reads through indexing, so reusing it
+        in the next iteration is safe.
+
+        Args:
+            labels (Tensor): Labels of all anchors.
+            dtype (torch.dtype): Dtype of the score.
+
+        Returns:
+            Tensor: Zeros with the same shape as ``labels``.
+        """
+        key = (labels.device, dtype)
+        buf = self._score_buf.get(key)
+        if buf is None or buf.numel() < labels.numel():
+            buf = labels.new_empty((labels.numel(), ), dtype=dtype)
+            self._score_buf[key] = buf
+        return buf[:labels.numel()].view(labels.shape).zero_()
+
+    @staticmethod
+    def _zero_loss(bbox_pred):
+        """Get a zero loss that stays connected to ``bbox_pred``.
+
+        Summing an empty slice keeps every parameter in the graph, as DDP
+        needs, without reducing over all anchors.
+        """
+        return bbox_pred[:0].sum()
 
     def loss_single(self, anchors, cls_score, bbox_pred, labels, label_weights,
                     bbox_targets, labels_neg, label_weights_neg,
-                    bbox_targets_neg, stride, assigned_neg, num_total_samples,
+                    bbox_targets_neg, inv_stride, assigned_neg,
+                    num_total_samples,
                     num_total_samples_neg):
-        """Compute loss of a single scale level.
+        """Compute loss of all scale levels, which are concatenated along the
+        anchor dimension.
 
         Args:
-            anchors (Tensor): Box reference for each scale level with shape
+            anchors (Tensor): Box reference of all scale levels with shape
                 (N, num_total_anchors, 4).
-            cls_score (Tensor): Cls and quality joint scores for each scale
-                level has shape (N, num_classes, H, W).
-            bbox_pred (Tensor): Box distribution logits for each scale
-                level with shape (N, 4*(n+1), H, W), n is max value of integral
-                set.
+            cls_score (Tensor): Cls and quality joint scores of all scale
+                levels with shape (N, num_total_anchors, num_classes).
+            bbox_pred (Tensor): Box distribution logits of all scale levels
+                with shape (N, num_total_anchors, 4*(n+1)), n is max value of
+                integral set.
             labels (Tensor): Labels of each anchors with shape
                 (N, num_total_anchors).
             label_weights (Tensor): Label weights of each anchor with shape
                 (N, num_total_anchors)
             bbox_targets (Tensor): BBox regression targets of each anchor wight
                 shape (N, num_total_anchors, 4).
-            stride (tuple): Stride in this scale level.
+            inv_stride (Tensor): Reciprocal of the stride of the scale level
+                each anchor belongs to, with shape (N, num_total_anchors).
             num_total_samples (int): Number of positive samples that is
                 reduced over all GPUs.
 
         Returns:
             dict[str, Tensor]: A dictionary of loss components.
         """
-        assert stride[0] == stride[1], 'h stride is not equal to w stride!'
         anchors = anchors.reshape(-1, 4)
-        cls_score = cls_score.permute(0, 2, 3,
-                                      1).reshape(-1, self.cls_out_channels)
-        bbox_pred = bbox_pred.permute(0, 2, 3,
-                                      1).reshape(-1, 4 * (self.reg_max + 1))
+        cls_score = cls_score.reshape(-1, self.cls_out_channels)
+        bbox_pred = bbox_pred.reshape(-1, 4 * (self.reg_max + 1))
+        inv_stride = inv_stride.reshape(-1)
         bbox_targets = bbox_targets.reshape(-1, 4)
         labels = labels.reshape(-1)
         label_weights = label_weights.reshape(-1)
@@ -256,25 +535,26 @@ class GFLHead(AnchorHead):
         pos_inds_neg = ((labels_neg >= 0)
                         & (labels_neg < bg_class_ind)).nonzero().squeeze(1)
 
-        score = label_weights.new_zeros(labels.shape)
-        score_neg = label_weights_neg.new_zeros(labels_neg.shape)
-        remain_inds = (assigned_neg > 0).nonzero().squeeze(1)
+        score = self._get_score_buffer(labels, label_weights.dtype)
+        remain_mask = assigned_neg > 0
+        if len(pos_inds) > 0 or len(pos_inds_neg) > 0:
+            # max cls score of each anchor, shared by both branches below
+            max_cls_score = cls_score.detach().sigmoid().max(dim=1)[0]
         if len(pos_inds) > 0:
             pos_bbox_targets = bbox_targets[pos_inds]
             pos_bbox_pred = bbox_pred[pos_inds]
             pos_anchors = anchors[pos_inds]
-            pos_anchor_centers = self.anchor_center(pos_anchors) / stride[0]
+            pos_inv_strides = inv_stride[pos_inds, None]
+            pos_anchor_centers = self.anchor_center(
+                pos_anchors) * pos_inv_strides
 
-            weight_targets = cls_score.detach().sigmoid()
-            weight_targets = weight_targets.max(dim=1)[0][pos_inds]
+            weight_targets = max_cls_score[pos_inds]
             pos_bbox_pred_corners = self.integral(pos_bbox_pred)
-            pos_decode_bbox_pred = distance2bbox(pos_anchor_centers,
-                                                 pos_bbox_pred_corners)
-            pos_decode_bbox_targets = pos_bbox_targets / stride[0]
-            score[pos_inds] = bbox_overlaps(
-                pos_decode_bbox_pred.detach(),
-                pos_decode_bbox_targets,
-                is_aligned=True)
+            pos_decode_bbox_pred = self._distance2bbox_out(
+                pos_anchor_centers, pos_bbox_pred_corners)
+            pos_decode_bbox_targets = pos_bbox_targets * pos_inv_strides
+            score[pos_inds] = aligned_iou(pos_decode_bbox_pred.detach(),
+                                          pos_decode_bbox_targets)
             pred_corners = pos_bbox_pred.reshape(-1, self.reg_max + 1)
             target_corners = bbox2distance(pos_anchor_centers,
                                            pos_decode_bbox_targets,
@@ -291,29 +571,29 @@ class GFLHead(AnchorHead):
             loss_dfl = self.loss_dfl(
                 pred_corners,
                 target_corners,
-                weight=weight_targets[:, None].expand(-1, 4).reshape(-1),
+                weight=weight_targets.repeat_interleave(4),
                 avg_factor=4.0)
         else:
-            loss_bbox = bbox_pred.sum() * 0
-            loss_dfl = bbox_pred.sum() * 0
+            loss_bbox = self._zero_loss(bbox_pred)
+            loss_dfl = self._zero_loss(bbox_pred)
             weight_targets = bbox_pred.new_tensor(0)
 
         if len(pos_inds_neg) > 0:
             pos_bbox_targets_neg = bbox_targets_neg[pos_inds_neg]
             pos_bbox_pred_neg = bbox_pred[pos_inds_neg]
             pos_anchors_neg = anchors[pos_inds_neg]
+            pos_inv_strides_neg = inv_stride[pos_inds_neg, None]
             pos_anchor_centers_neg = self.anchor_center(
-                pos_anchors_neg) / stride[0]
+                pos_anchors_neg) * pos_inv_strides_neg
 
-            weight_targetss = ((cls_score.detach().sigmoid().max(dim=1)[0]) <
-                               0).float()
-            weight_targets_neg = weight_targetss[remain_inds] + assigned_neg[
-                remain_inds]
+            weight_targetss = (max_cls_score < 0).float()
+            weight_targets_neg = (weight_targetss + assigned_neg)[remain_mask]
 
             pos_bbox_pred_corners_neg = self.integral(pos_bbox_pred_neg)
-            pos_decode_bbox_pred_neg = distance2bbox(
+            pos_decode_bbox_pred_neg = self._distance2bbox_out(
                 pos_anchor_centers_neg, pos_bbox_pred_corners_neg)
-            pos_decode_bbox_targets_neg = pos_bbox_targets_neg / stride[0]
+            pos_decode_bbox_targets_neg = (
+                pos_bbox_targets_neg * pos_inv_strides_neg)
             '''
             score[pos_inds_neg] = bbox_overlaps(
                 pos_decode_bbox_pred_neg.detach(),
@@ -336,7 +616,7 @@ class GFLHead(AnchorHead):
             loss_dfl_neg = 0.125 * self.loss_dfl(
                 pred_corners_neg,
                 target_corners_neg,
-                weight=weight_targets_neg[:, None].expand(-1, 4).reshape(-1),
+                weight=weight_targets_neg.repeat_interleave(4),
                 avg_factor=4.0)
             '''
             loss_cls = self.loss_cls(
@@ -350,8 +630,8 @@ class GFLHead(AnchorHead):
                 raise NotImplementedError
             '''
         else:
-            loss_bbox_neg = bbox_pred.sum() * 0
-            loss_dfl_neg = bbox_pred.sum() * 0
+            loss_bbox_neg = self._zero_loss(bbox_pred)
+            loss_dfl_neg = self._zero_loss(bbox_pred)
             weight_targets_neg = bbox_pred.new_tensor(0)
 
         # cls (qfl) loss
@@ -419,44 +699,57 @@ class GFLHead(AnchorHead):
          num_total_pos_neg, num_total_neg_neg,
          assigned_neg_list) = cls_reg_targets
 
-        num_total_samples = reduce_mean(
-            torch.tensor(num_total_pos, dtype=torch.float,
-                         device=device)).item()
+        # reduce both sample numbers with one copy to device and one sync
+        num_total_samples, num_total_samples_neg = reduce_mean(
+            torch.tensor([num_total_pos, num_total_pos_neg],
+                         dtype=torch.float,
+                         device=device)).tolist()
         num_total_samples = max(num_total_samples, 1.0)
-
-        num_total_samples_neg = reduce_mean(
-            torch.tensor(num_total_pos_neg, dtype=torch.float,
-                         device=device)).item()
         num_total_samples_neg = max(num_total_samples_neg, 1.0)
 
-        losses_cls, losses_bbox, losses_dfl, avg_factor, losses_bbox_neg, losses_dfl_neg,\
-            avg_factor_neg = multi_apply(
-                self.loss_single,
-                anchor_list,
-                cls_scores,
-                bbox_preds,
-                labels_list,
-                label_weights_list,
-                bbox_targets_list,
-                labels_list_neg,
-                label_weights_list_neg,
-                bbox_targets_list_neg,
-                self.anchor_generator.strides,
-                assigned_neg_list,
+        # concat all levels along the anchor dim, so that the losses of the
+        # whole pyramid are computed in one pass instead of once per level
+        num_imgs = len(img_metas)
+        inv_stride_list = []
+        for level_anchors, stride in zip(anchor_list,
+                                         self.anchor_generator.strides):
+            assert stride[0] == stride[1], 'h stride is not equal to w stride!'
+            inv_stride_list.append(
+                level_anchors.new_full(level_anchors.shape[:2],
+                                       1.0 / stride[0]))
+        cls_score = torch.cat([
+            cls_score.permute(0, 2, 3, 1).reshape(num_imgs, -1,
+                                                  self.cls_out_channels)
+            for cls_score in cls_scores
+        ], 1)
+        bbox_pred = torch.cat([
+            bbox_pred.permute(0, 2, 3, 1).reshape(num_imgs, -1,
+                                                  4 * (self.reg_max + 1))
+            for bbox_pred in bbox_preds
+        ], 1)
+
+        losses_cls, losses_bbox, losses_dfl, avg_factor, losses_bbox_neg,\
+            losses_dfl_neg, avg_factor_neg = self.loss_single(
+                torch.cat(anchor_list, 1),
+                cls_score,
+                bbox_pred,
+                torch.cat(labels_list, 1),
+                torch.cat(label_weights_list, 1),
+                torch.cat(bbox_targets_list, 1),
+                torch.cat(labels_list_neg, 1),
+                torch.cat(label_weights_list_neg, 1),
+                torch.cat(bbox_targets_list_neg, 1),
+                torch.cat(inv_stride_list, 1),
+                torch.cat(assigned_neg_list, 1),
                 num_total_samples=num_total_samples,
                 num_total_samples_neg=num_total_samples_neg)
-        avg_factor = sum(avg_factor)
-        avg_factor = reduce_mean(avg_factor).item()
-        losses_bbox = list(map(lambda x: x / avg_factor, losses_bbox))
-        losses_dfl = list(map(lambda x: x / avg_factor, losses_dfl))
-
-        avg_factor_neg = sum(avg_factor_neg)
-        avg_factor_neg = reduce_mean(avg_factor_neg).item()
-
-        losses_bbox_neg = list(
-            map(lambda x: x / avg_factor_neg, losses_bbox_neg))
-        losses_dfl_neg = list(
-            map(lambda x: x / avg_factor_neg, losses_dfl_neg))
+        # normalize all box losses with one divide and without reading the
+        # reduced avg factors back to host
+        avg_factors = reduce_mean(torch.stack([avg_factor, avg_factor_neg]))
+        losses_bbox, losses_dfl, losses_bbox_neg, losses_dfl_neg = (
+            torch.stack(
+                [losses_bbox, losses_dfl, losses_bbox_neg, losses_dfl_neg]) /
+            avg_factors.repeat_interleave(2)).unbind()
 
         return dict(
             loss_cls=losses_cls,
@@ -525,11 +818,12 @@ class GFLHead(AnchorHead):
             if nms_pre > 0 and scores.shape[1] > nms_pre:
                 max_scores, _ = scores.max(-1)
                 _, topk_inds = max_scores.topk(nms_pre)
-                batch_inds = torch.arange(batch_size).view(
-                    -1, 1).expand_as(topk_inds).long()
                 anchors = anchors[topk_inds, :]
-                bbox_pred = bbox_pred[batch_inds, topk_inds, :]
-                scores = scores[batch_inds, topk_inds, :]
+                bbox_pred = bbox_pred.gather(
+                    1, topk_inds[..., None].expand(-1, -1, 4))
+                scores = scores.gather(
+                    1, topk_inds[..., None].expand(-1, -1,
+                                                   self.cls_out_channels))
             else:
                 anchors = anchors.expand_as(bbox_pred)
 
@@ -832,9 +1126,77 @@ class GFLHead(AnchorHead):
     #             bbox_targets_neg, bbox_weights_neg, pos_inds_neg, neg_inds_neg,
     #             assigned_neg)
 
+    def _get_level_ids(self, num_level_anchors, device):
+        """Get the scale level index of every anchor.
+
+        The level ids only depend on the number of anchors of each level,
+        which is the same across iterations for a fixed input size, so the
+        ids of the last layout seen are kept and rebuilt only when it changes.
+
+        Args:
+            num_level_anchors (list[int]): Number of anchors of each level.
+            device (torch.device): Device of the anchors.
+
+        Returns:
+            Tensor: Level index of every anchor, shape (num_anchors, ).
+        """
+        key = (tuple(num_level_anchors), device)
+        if self._level_ids_key != key:
+            self._level_ids = torch.repeat_interleave(
+                torch.arange(len(num_level_anchors), device=device),
+                torch.as_tensor(num_level_anchors, device=device))
+            self._level_ids_key = key
+        return self._level_ids
+
     def get_num_level_anchors_inside(self, num_level_anchors, inside_flags):
-        split_inside_flags = torch.split(inside_flags, num_level_anchors)
-        num_level_anchors_inside = [
-            int(flags.sum()) for flags in split_inside_flags
-        ]
-        return num_level_anchors_inside
+        """Count the anchors inside the image for each scale level.
+
+        Every anchor is tagged with the index of its scale level, so a single
+        `scatter_add_` sums the flags of all levels and the counts reach the
+        host with a single sync.
+        """
+        level_ids = self._get_level_ids(num_level_anchors, inside_flags.device)
+        return count_per_level(inside_flags, level_ids,
+                               len(num_level_anchors)).tolist()
+
+    def get_batch_inside_flags(self, flat_anchor_list, valid_flag_list,
+                               num_level_anchors, img_metas):
+        """Get the inside flags and their per-level counts of all images.
+
+        Works like `anchor_inside_flags` and
+        :meth:`get_num_level_anchors_inside` on every image, but with the
+        images stacked along a leading dimension, so that the counts of the
+        whole batch reach the host with a single sync.
+
+        Args:
+            flat_anchor_list (list[Tensor]): Multi-level anchors of each
+                image, which are concatenated into a single tensor of shape
+                (num_anchors, 4).
+            valid_flag_list (list[Tensor]): Multi level valid flags of each
+                image, which are concatenated into a single tensor of shape
+                (num_anchors,).
+            num_level_anchors (list[int]): Number of anchors of each level.
+            img_metas (list[dict]): Meta info of each image.
+
+        Returns:
+            tuple:
+                inside_flags_list (list[Tensor]): Inside flags of each image
+                    with shape (num_anchors,).
+                num_level_anchors_inside_list (list[list[int]]): Number of
+                    inside anchors of each level for each image.
+        """
+        inside_flags = torch.stack(valid_flag_list)
+        allowed_border = self.train_cfg.allowed_border
+        if allowed_border >= 0:
+            flat_anchors = torch.stack(flat_anchor_list)
+            img_shapes = flat_anchors.new_tensor(
+                [img_meta['img_shape'][:2] for img_meta in img_metas])
+            inside_flags = inside_flags & \
+                (flat_anchors[..., 0] >= -allowed_border) & \
+                (flat_anchors[..., 1] >= -allowed_border) & \
+                (flat_anchors[..., 2] < img_shapes[:, 1:] + allowed_border) & \
+                (flat_anchors[..., 3] < img_shapes[:, :1] + allowed_border)
+        level_ids = self._get_level_ids(num_level_anchors, inside_flags.device)
+        counts = count_per_level(inside_flags, level_ids,
+                                 len(num_level_anchors))
+        return list(inside_flags.unbind(0)), counts.tolist()
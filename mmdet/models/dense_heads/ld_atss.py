@@ -427,18 +427,14 @@ class LDATSSHead(ATSSGFLHead):
         num_level_anchors_inside = self.get_num_level_anchors_inside(
             num_level_anchors, inside_flags)
 
-        assign_result = self.assigner.assign(anchors, num_level_anchors_inside,
-                                             gt_bboxes, gt_bboxes_ignore,
-                                             gt_labels)
+        # the assignment and the VLR share the iou and the candidates
+        assign_result, vlr_region = self.assigner.assign_with_vlr_region(
+            anchors, num_level_anchors_inside, gt_bboxes, gt_bboxes_ignore,
+            gt_labels)
 
         sampling_result = self.sampler.sample(assign_result, anchors,
                                               gt_bboxes)
 
-        vlr_region = self.assigner.get_vlr_region(anchors,
-                                                  num_level_anchors_inside,
-                                                  gt_bboxes, gt_bboxes_ignore,
-                                                  gt_labels)
-
         im_region = vlr_region
 
         num_valid_anchors = anchors.shape[0]
@@ -1,12 +1,11 @@
 import torch
 from mmcv.runner import force_fp32
 
-from mmdet.core import (bbox2distance, bbox_overlaps, distance2bbox,
-                        images_to_levels, anchor_inside_flags, unmap,
+from mmdet.core import (bbox2distance, distance2bbox, images_to_levels,
                         multi_apply, reduce_mean)
 from mmdet.core.bbox.iou_calculators import build_iou_calculator
 from ..builder import HEADS, build_loss
-from .gfl_head import GFLHead
+from .gfl_head import GFLHead, aligned_iou
 
 
 def intersect(box_a, box_b):
@@ -133,8 +132,8 @@ class LDHead(GFLHead):
             bbox_targets (Tensor): BBox regression targets of each anchor wight
                 shape (N, num_total_anchors, 4).
             stride (tuple): Stride in this scale level.
-            num_total_samples (int): Number of positive samples that is
-                reduced over all GPUs.
+            num_total_samples (Tensor): Number of positive samples that is
+                reduced over all GPUs, a scalar tensor.
 
         Returns:
             dict[tuple, Tensor]: Loss components and weight targets.
@@ -182,29 +181,28 @@ class LDHead(GFLHead):
                                        teacher_x[fg_inds]) + 2 * self.loss_im(
                                            x[ng_inds], teacher_x[fg_inds])
             else:
-                loss_im = bbox_pred.sum() * 0
+                loss_im = self._zero_loss(bbox_pred)
         else:
             fg_inds = (im_region > 0).nonzero().squeeze(1)
             if len(fg_inds) > 0:
                 loss_im = self.loss_im(x[fg_inds], teacher_x[fg_inds])
             else:
-                loss_im = bbox_pred.sum() * 0
+                loss_im = self._zero_loss(bbox_pred)
         if len(pos_inds) > 0:
             pos_bbox_targets = bbox_targets[pos_inds]
             pos_bbox_pred = bbox_pred[pos_inds]
             pos_anchors = anchors[pos_inds]
-            pos_anchor_centers = self.anchor_center(pos_anchors) / stride[0]
+            inv_stride = 1.0 / stride[0]
+            pos_anchor_centers = self.anchor_center(pos_anchors) * inv_stride
 
             weight_targets = cls_score.detach().sigmoid()
             weight_targets = weight_targets.max(dim=1)[0][pos_inds]
             pos_bbox_pred_corners = self.integral(pos_bbox_pred)
-            pos_decode_bbox_pred = distance2bbox(pos_anchor_centers,
-                                                 pos_bbox_pred_corners)
-            pos_decode_bbox_targets = pos_bbox_targets / stride[0]
-            score[pos_inds] = bbox_overlaps(
-                pos_decode_bbox_pred.detach(),
-                pos_decode_bbox_targets,
-                is_aligned=True)
+            pos_decode_bbox_pred = self._distance2bbox_out(
+                pos_anchor_centers, pos_bbox_pred_corners)
+            pos_decode_bbox_targets = pos_bbox_targets * inv_stride
+            score[pos_inds] = aligned_iou(pos_decode_bbox_pred.detach(),
+                                          pos_decode_bbox_targets)
 
             # anchor_centers = self.anchor_center(anchors) / stride[0]
             # in_gt = torch.zeros(x.shape[-1], x.shape[-2], device='cuda')
@@ -224,18 +222,20 @@ class LDHead(GFLHead):
                 pos_decode_bbox_targets,
                 weight=weight_targets,
                 avg_factor=1.0)
+            # weight of each of the 4 corners, shared by dfl and ld loss
+            corner_weight_targets = weight_targets.repeat_interleave(4)
             # dfl loss
             loss_dfl = self.loss_dfl(
                 pred_corners,
                 target_corners,
-                weight=weight_targets[:, None].expand(-1, 4).reshape(-1),
+                weight=corner_weight_targets,
                 avg_factor=4.0)
 
             # ld loss
             loss_ld = self.loss_ld(
                 pred_corners,
                 soft_corners,
-                weight=weight_targets[:, None].expand(-1, 4).reshape(-1),
+                weight=corner_weight_targets,
                 avg_factor=4.0)
             loss_kd = self.loss_kd(
                 cls_score[pos_inds],
@@ -244,11 +244,11 @@ class LDHead(GFLHead):
                 avg_factor=pos_inds.shape[0])
 
         else:
-            loss_ld = bbox_pred.sum() * 0
-            loss_bbox = bbox_pred.sum() * 0
-            loss_dfl = bbox_pred.sum() * 0
-            loss_kd = bbox_pred.sum() * 0
-            loss_im = bbox_pred.sum() * 0
+            loss_ld = self._zero_loss(bbox_pred)
+            loss_bbox = self._zero_loss(bbox_pred)
+            loss_dfl = self._zero_loss(bbox_pred)
+            loss_kd = self._zero_loss(bbox_pred)
+            loss_im = self._zero_loss(bbox_pred)
             weight_targets = bbox_pred.new_tensor(0)
 
         if len(remain_inds) > 0:
@@ -262,7 +262,7 @@ class LDHead(GFLHead):
             loss_ld_vlr = self.loss_ld_vlr(
                 neg_pred_corners,
                 neg_soft_corners,
-                weight=remain_targets[:, None].expand(-1, 4).reshape(-1),
+                weight=remain_targets.repeat_interleave(4),
                 avg_factor=16.0)
             loss_kd_neg = 0 * self.loss_kd(
                 cls_score[remain_inds],
@@ -270,8 +270,8 @@ class LDHead(GFLHead):
                 weight=label_weights[remain_inds],
                 avg_factor=remain_inds.shape[0])
         else:
-            loss_ld_vlr = bbox_pred.sum() * 0
-            loss_kd_neg = bbox_pred.sum() * 0
+            loss_ld_vlr = self._zero_loss(bbox_pred)
+            loss_kd_neg = self._zero_loss(bbox_pred)
 
         loss_cls = self.loss_cls(
             cls_score, (labels, score),
@@ -335,10 +335,10 @@ class LDHead(GFLHead):
          bbox_weights_list, num_total_pos, num_total_neg, assigned_neg_list,
          im_region_list) = cls_reg_targets
 
+        # the normalizers stay on device, the losses only divide by them
         num_total_samples = reduce_mean(
             torch.tensor(num_total_pos, dtype=torch.float,
-                         device=device)).item()
-        num_total_samples = max(num_total_samples, 1.0)
+                         device=device)).clamp(min=1.0)
 
         losses_cls, losses_bbox, losses_dfl, losses_ld, losses_ld_vlr, losses_kd, losses_kd_neg, losses_im,\
             avg_factor = multi_apply(
@@ -360,9 +360,9 @@ class LDHead(GFLHead):
         )
 
         avg_factor = sum(avg_factor) + 1e-6
-        avg_factor = reduce_mean(avg_factor).item()
-        losses_bbox = [x / avg_factor for x in losses_bbox]
-        losses_dfl = [x / avg_factor for x in losses_dfl]
+        avg_factor = reduce_mean(avg_factor)
+        losses_bbox = list((torch.stack(losses_bbox) / avg_factor).unbind())
+        losses_dfl = list((torch.stack(losses_dfl) / avg_factor).unbind())
         return dict(
             loss_cls=losses_cls,
             loss_bbox=losses_bbox,
@@ -394,7 +394,6 @@ class LDHead(GFLHead):
 
         # anchor number of multi levels
         num_level_anchors = [anchors.size(0) for anchors in anchor_list[0]]
-        num_level_anchors_list = [num_level_anchors] * num_imgs
 
         # concat all level anchors and flags to a single tensor
         for i in range(num_imgs):
@@ -402,6 +401,14 @@ class LDHead(GFLHead):
             anchor_list[i] = torch.cat(anchor_list[i])
             valid_flag_list[i] = torch.cat(valid_flag_list[i])
 
+        # inside flags and per-level counts of all images at once
+        inside_flags_list, num_level_anchors_inside_list = \
+            self.get_batch_inside_flags(anchor_list, valid_flag_list,
+                                        num_level_anchors, img_metas)
+        # all images share the same anchors, so their centers are computed
+        # once, as contiguous x and y rows, and gathered for each image
+        anchor_centers = self.anchor_center(anchor_list[0]).t().contiguous()
+
         # compute targets for each image
         if gt_bboxes_ignore_list is None:
             gt_bboxes_ignore_list = [None for _ in range(num_imgs)]
@@ -413,14 +420,15 @@ class LDHead(GFLHead):
          all_im_region) = multi_apply(
              self._get_target_single,
              anchor_list,
-             valid_flag_list,
-             num_level_anchors_list,
+             inside_flags_list,
+             num_level_anchors_inside_list,
              gt_bboxes_list,
              gt_bboxes_ignore_list,
              gt_labels_list,
              img_metas,
              label_channels=label_channels,
-             unmap_outputs=unmap_outputs)
+             unmap_outputs=unmap_outputs,
+             anchor_centers=anchor_centers)
 
         # no valid anchors
         if any([labels is None for labels in all_labels]):
@@ -448,24 +456,26 @@ class LDHead(GFLHead):
 
     def _get_target_single(self,
                            flat_anchors,
-                           valid_flags,
-                           num_level_anchors,
+                           inside_flags,
+                           num_level_anchors_inside,
                            gt_bboxes,
                            gt_bboxes_ignore,
                            gt_labels,
                            img_meta,
                            label_channels=1,
-                           unmap_outputs=True):
+                           unmap_outputs=True,
+                           anchor_centers=None):
         """Compute regression, classification targets for anchors in a single
         image.
 
         Args:
             flat_anchors (Tensor): Multi-level anchors of the image, which are
                 concatenated into a single tensor of shape (num_anchors, 4)
-            valid_flags (Tensor): Multi level valid flags of the image,
+            inside_flags (Tensor): Multi level inside flags of the image,
                 which are concatenated into a single tensor of
                     shape (num_anchors,).
-            num_level_anchors Tensor): Number of anchors of each scale level.
+            num_level_anchors_inside (list[int]): Number of inside anchors of
+                each scale level.
             gt_bboxes (Tensor): Ground truth bboxes of the image,
                 shape (num_gts, 4).
             gt_bboxes_ignore (Tensor): Ground truth bboxes to be
@@ -476,6 +486,8 @@ class LDHead(GFLHead):
             label_channels (int): Channel of label.
             unmap_outputs (bool): Whether to map outputs back to the original
                 set of anchors.
+            anchor_centers (Tensor, optional): X and y of the centers of
+                flat_anchors with shape (2, num_anchors).
 
         Returns:
             tuple: N is the number of total anchors in the image.
@@ -493,31 +505,28 @@ class LDHead(GFLHead):
                 neg_inds (Tensor): Indices of negative anchor with shape
                     (num_neg,).
         """
-        inside_flags = anchor_inside_flags(flat_anchors, valid_flags,
-                                           img_meta['img_shape'][:2],
-                                           self.train_cfg.allowed_border)
-        if not inside_flags.any():
-            return (None, ) * 7
+        if sum(num_level_anchors_inside) == 0:
+            return (None, ) * 9
+        # convert the mask to indices once and reuse them for the gather and
+        # the packed index_copy_ that maps the targets back below
+        inside_inds = inside_flags.nonzero().squeeze(1)
         # assign gt and sample anchors
-        anchors = flat_anchors[inside_flags, :]
-
-        num_level_anchors_inside = self.get_num_level_anchors_inside(
-            num_level_anchors, inside_flags)
+        anchors = flat_anchors.index_select(0, inside_inds)
+        if anchor_centers is None:
+            anchor_centers = self.anchor_center(flat_anchors).t()
+        centers = anchor_centers.index_select(1, inside_inds).unbind(0)
 
-        assign_result = self.assigner.assign(anchors, num_level_anchors_inside,
-                                             gt_bboxes, gt_bboxes_ignore,
-                                             gt_labels)
+        # the assignment and the VLR share the iou and the candidates
+        assign_result, vlr_region = self.assigner.assign_with_vlr_region(
+            anchors, num_level_anchors_inside, gt_bboxes, gt_bboxes_ignore,
+            gt_labels, bbox_centers=centers)
 
         sampling_result = self.sampler.sample(assign_result, anchors,
                                               gt_bboxes)
 
-        vlr_region = self.assigner.get_vlr_region(anchors,
-                                                  num_level_anchors_inside,
-                                                  gt_bboxes, gt_bboxes_ignore,
-                                                  gt_labels)
-
         im_region = self.get_im_region(
-            anchors, gt_bboxes, mode=self.imitation_method)
+            anchors, gt_bboxes, mode=self.imitation_method,
+            bbox_centers=centers)
 
         num_valid_anchors = anchors.shape[0]
         bbox_targets = torch.zeros_like(anchors)
@@ -526,9 +535,6 @@ class LDHead(GFLHead):
         labels = anchors.new_full((num_valid_anchors, ),
                                   self.num_classes,
                                   dtype=torch.long)
-        labels_neg = anchors.new_full((num_valid_anchors, ),
-                                      self.num_classes,
-                                      dtype=torch.long)
 
         label_weights = anchors.new_zeros(num_valid_anchors, dtype=torch.float)
 
@@ -556,28 +562,53 @@ class LDHead(GFLHead):
 
         # map up to original set of anchors
         if unmap_outputs:
-            num_total_anchors = flat_anchors.size(0)
-            anchors = unmap(anchors, num_total_anchors, inside_flags)
-            labels = unmap(
-                labels, num_total_anchors, inside_flags, fill=self.num_classes)
-            label_weights = unmap(label_weights, num_total_anchors,
-                                  inside_flags)
-            bbox_targets = unmap(bbox_targets, num_total_anchors, inside_flags)
-            bbox_weights = unmap(bbox_weights, num_total_anchors, inside_flags)
-            vlr_region = unmap(vlr_region, num_total_anchors, inside_flags)
-            im_region = unmap(im_region, num_total_anchors, inside_flags)
-
-            labels_neg = unmap(
-                labels_neg,
-                num_total_anchors,
-                inside_flags,
-                fill=self.num_classes)
+            (anchors, labels, label_weights, bbox_targets, bbox_weights,
+             vlr_region, im_region) = self._unmap_targets(
+                 flat_anchors.size(0), inside_inds, anchors, labels,
+                 label_weights, bbox_targets, bbox_weights, vlr_region,
+                 im_region)
 
         return (anchors, labels, label_weights, bbox_targets, bbox_weights,
                 pos_inds, neg_inds, vlr_region, im_region)
 
+    def _unmap_targets(self, num_total_anchors, inside_inds, anchors, labels,
+                       label_weights, bbox_targets, bbox_weights, vlr_region,
+                       im_region):
+        """Map the targets of the inside anchors back to all anchors.
+
+        All targets are packed column-wise so that a single `index_copy_`
+        maps them back, the labels are exactly representable in float.
+        Outside anchors get zeros, except for the labels which are filled
+        with the background index `num_classes`, the same as `unmap`.
+
+        Args:
+            num_total_anchors (int): Number of all anchors in the image.
+            inside_inds (Tensor): Indices of the inside anchors, shape (n, ).
+            anchors, bbox_targets, bbox_weights (Tensor): Shape (n, 4).
+            labels, label_weights, vlr_region, im_region (Tensor): Shape
+                (n, ).
+
+        Returns:
+            tuple[Tensor]: The inputs except the indices, in the same order
+                and each with num_total_anchors rows.
+        """
+        packed = torch.cat(
+            (anchors, bbox_targets, bbox_weights, label_weights[:, None],
+             vlr_region[:, None], im_region[:, None].to(anchors),
+             labels[:, None].to(anchors)),
+            dim=1)
+        full = packed.new_zeros((num_total_anchors, packed.size(1)))
+        full[:, -1] = self.num_classes
+        full.index_copy_(0, inside_inds, packed)
+        anchors, bbox_targets, bbox_weights = full[:, :12].split(4, dim=1)
+        label_weights, vlr_region, im_region = full[:, 12:15].unbind(1)
+        labels = full[:, 15].long()
+        return (anchors, labels, label_weights, bbox_targets, bbox_weights,
+                vlr_region, im_region)
+
     # imitation region
-    def get_im_region(self, bboxes, gt_bboxes, mode='fitnet'):
+    def get_im_region(self, bboxes, gt_bboxes, mode='fitnet',
+                      bbox_centers=None):
         assert mode in ['gibox', 'finegrained', 'fitnet', 'decouple']
         num_gt, num_bboxes = gt_bboxes.size(0), bboxes.size(0)
 
@@ -595,13 +626,15 @@ class LDHead(GFLHead):
         fine_grained = torch.nonzero(iou > 0.5 * iou.max(0)[0])
         assigned_fg[fine_grained[:, 0]] = 1
         gt_flag = torch.zeros(bboxes.shape[0])
-        anchor_center = self.anchor_center(bboxes)
+        if bbox_centers is None:
+            bbox_centers = self.anchor_center(bboxes).unbind(1)
+        centers_x, centers_y = bbox_centers
         for gt_bbox in gt_bboxes:
             in_gt_flag = torch.nonzero(
-                (anchor_center[:, 0] > gt_bbox[0])
-                & (anchor_center[:, 0] < gt_bbox[2])
-                & (anchor_center[:, 1] > gt_bbox[1])
-                & (anchor_center[:, 1] < gt_bbox[3]),
+                (centers_x > gt_bbox[0])
+                & (centers_x < gt_bbox[2])
+                & (centers_y > gt_bbox[1])
+                & (centers_y < gt_bbox[3]),
                 as_tuple=False)
             gt_flag[in_gt_flag] = 1
 
@@ -4,9 +4,10 @@ CommandLine:
     pytest tests/test_assigner.py
     xdoctest tests/test_assigner.py zero
 """
+import pytest
 import torch
 
-from mmdet.core.bbox.assigners import (ApproxMaxIoUAssigner,
+from mmdet.core.bbox.assigners import (ApproxMaxIoUAssigner, ATSSAssigner,
                                        CenterRegionAssigner, MaxIoUAssigner,
                                        PointAssigner)
 
@@ -376,3 +377,95 @@ def test_center_region_assigner_with_empty_gts():
     assert len(assign_result.gt_inds) == 2
     expected_gt_inds = torch.LongTensor([0, 0])
     assert torch.all(assign_result.gt_inds == expected_gt_inds)
+
+
+def test_atss_assigner_numba():
+    pytest.importorskip('numba')
+    bboxes = torch.FloatTensor([
+        [0, 0, 10, 10],
+        [10, 10, 20, 20],
+        [5, 5, 15, 15],
+        [32, 32, 38, 42],
+        [0, 0, 20, 20],
+        [10, 0, 30, 20],
+    ])
+    num_level_bboxes = [4, 2]
+    gt_bboxes = torch.FloatTensor([
+        [0, 0, 10, 9],
+        [0, 10, 10, 19],
+    ])
+    gt_labels = torch.LongTensor([2, 3])
+    expected = ATSSAssigner(topk=2).assign(
+        bboxes, num_level_bboxes, gt_bboxes, gt_labels=gt_labels)
+    assign_result = ATSSAssigner(
+        topk=2, use_numba=True).assign(
+            bboxes, num_level_bboxes, gt_bboxes, gt_labels=gt_labels)
+    assert torch.all(assign_result.gt_inds == expected.gt_inds)
+    assert torch.all(assign_result.labels == expected.labels)
+    assert torch.allclose(assign_result.max_overlaps, expected.max_overlaps)
+
+    # gts aligned with the anchor grids have candidates at tied distances,
+    # which both paths may order differently, so only the number of
+    # positives is compared
+    bboxes = []
+    for stride, size in [(8, 8), (16, 4)]:
+        centers = (torch.arange(size).float() + 0.5) * stride
+        cx = centers.repeat(size)
+        cy = centers.repeat_interleave(size)
+        bboxes.append(
+            torch.stack([cx - stride, cy - stride, cx + stride, cy + stride],
+                        dim=1))
+    bboxes = torch.cat(bboxes)
+    num_level_bboxes = [64, 16]
+    gt_bboxes = torch.FloatTensor([
+        [16, 16, 48, 48],
+        [8, 24, 40, 56],
+    ])
+    expected = ATSSAssigner(topk=9).assign(bboxes, num_level_bboxes,
+                                           gt_bboxes)
+    assign_result = ATSSAssigner(
+        topk=9, use_numba=True).assign(bboxes, num_level_bboxes, gt_bboxes)
+    assert (assign_result.gt_inds > 0).sum() == (expected.gt_inds > 0).sum()
+
+
+def test_atss_assigner_with_vlr_region():
+    bboxes = torch.FloatTensor([
+        [0, 0, 10, 10],
+        [10, 10, 20, 20],
+        [5, 5, 15, 15],
+        [32, 32, 38, 42],
+        [0, 0, 20, 20],
+        [10, 0, 30, 20],
+    ])
+    num_level_bboxes = [4, 2]
+    gt_bboxes = torch.FloatTensor([
+        [0, 0, 10, 9],
+        [0, 10, 10, 19],
+    ])
+    gt_labels = torch.LongTensor([2, 3])
+    self = ATSSAssigner(topk=2)
+    expected = self.assign(
+        bboxes, num_level_bboxes, gt_bboxes, gt_labels=gt_labels)
+    expected_vlr_region = self.get_vlr_region(
+        bboxes, num_level_bboxes, gt_bboxes, gt_labels=gt_labels)
+    assign_result, vlr_region = self.assign_with_vlr_region(
+        bboxes, num_level_bboxes, gt_bboxes, gt_labels=gt_labels)
+    assert torch.all(assign_result.gt_inds == expected.gt_inds)
+    assert torch.all(assign_result.labels == expected.labels)
+    assert torch.allclose(assign_result.max_overlaps, expected.max_overlaps)
+    assert torch.allclose(vlr_region, expected_vlr_region)
+
+    # level sizes given as a tensor
+    assign_result, vlr_region = self.assign_with_vlr_region(
+        bboxes,
+        torch.LongTensor(num_level_bboxes),
+        gt_bboxes,
+        gt_labels=gt_labels)
+    assert torch.all(assign_result.gt_inds == expected.gt_inds)
+    assert torch.allclose(vlr_region, expected_vlr_region)
+
+    # no gt
+    assign_result, vlr_region = self.assign_with_vlr_region(
+        bboxes, num_level_bboxes, gt_bboxes[:0], gt_labels=gt_labels[:0])
+    assert torch.all(assign_result.gt_inds == 0)
+    assert vlr_region.shape == (6, ) and not vlr_region.any()
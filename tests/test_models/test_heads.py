@@ -1,13 +1,18 @@
+import os
+
 import mmcv
 import numpy as np
+import pytest
 import torch
 
-from mmdet.core import bbox2roi, build_assigner, build_sampler
+from mmdet.core import (anchor_inside_flags, bbox2roi, build_assigner,
+                        build_sampler, unmap)
 from mmdet.core.evaluation.bbox_overlaps import bbox_overlaps
 from mmdet.models.dense_heads import (AnchorHead, CornerHead, FCOSHead,
-                                      FSAFHead, GuidedAnchorHead, PAAHead,
-                                      SABLRetinaHead, YOLACTHead,
-                                      YOLACTProtonet, YOLACTSegmHead, paa_head)
+                                      FSAFHead, GFLHead, GuidedAnchorHead,
+                                      LDHead, PAAHead, SABLRetinaHead,
+                                      YOLACTHead, YOLACTProtonet,
+                                      YOLACTSegmHead, paa_head)
 from mmdet.models.dense_heads.paa_head import levels_to_images
 from mmdet.models.roi_heads.bbox_heads import BBoxHead, SABLHead
 from mmdet.models.roi_heads.mask_heads import FCNMaskHead, MaskIoUHead
@@ -1170,3 +1175,140 @@ def test_yolact_head_loss():
     one_gt_mask_loss = sum(one_gt_mask_loss['loss_mask'])
     assert one_gt_segm_loss.item() > 0, 'segm loss should be non-zero'
     assert one_gt_mask_loss.item() > 0, 'mask loss should be non-zero'
+
+
+def test_integral_triton():
+    """Tests the triton integral kernel against the scripted one."""
+    pytest.importorskip('triton')
+    from mmdet.models.dense_heads.gfl_head import (integral_forward,
+                                                   integral_forward_triton)
+    if torch.cuda.is_available():
+        device = 'cuda'
+    elif os.environ.get('TRITON_INTERPRET') == '1':
+        device = 'cpu'
+    else:
+        pytest.skip('triton needs CUDA or TRITON_INTERPRET=1')
+
+    reg_max = 16
+    # more rows than a single block of the kernel, not a multiple of it
+    x = torch.randn(100, 4 * (reg_max + 1), device=device)
+    project = torch.linspace(0, reg_max, reg_max + 1, device=device)
+    expected = integral_forward(x, project, reg_max)
+    out = integral_forward_triton(x, reg_max)
+    assert out.shape == (100, 4)
+    assert torch.allclose(out, expected, atol=1e-4)
+
+
+def test_ld_head_unmap_targets():
+    """Tests the packed unmap of LD targets against per-tensor unmap."""
+    train_cfg = mmcv.Config(
+        dict(
+            assigner=dict(type='ATSSAssigner', topk=9),
+            allowed_border=-1,
+            pos_weight=-1,
+            debug=False))
+    num_classes = 4
+    self = LDHead(
+        num_classes=num_classes,
+        in_channels=1,
+        train_cfg=train_cfg,
+        anchor_generator=dict(
+            type='AnchorGenerator',
+            ratios=[1.0],
+            octave_base_scale=8,
+            scales_per_octave=1,
+            strides=[8, 16, 32, 64, 128]),
+        loss_cls=dict(
+            type='QualityFocalLoss',
+            use_sigmoid=True,
+            beta=2.0,
+            loss_weight=1.0),
+        loss_bbox=dict(type='GIoULoss', loss_weight=2.0))
+
+    num_total_anchors = 50
+    inside_flags = torch.rand(num_total_anchors) > 0.3
+    inside_inds = inside_flags.nonzero().squeeze(1)
+    n = len(inside_inds)
+    anchors = torch.rand(n, 4) * 100
+    labels = torch.randint(0, num_classes + 1, (n, ))
+    label_weights = torch.rand(n)
+    bbox_targets = torch.rand(n, 4) * 100
+    bbox_weights = torch.rand(n, 4)
+    vlr_region = torch.rand(n)
+    im_region = torch.rand(n)
+
+    outs = self._unmap_targets(num_total_anchors, inside_inds, anchors,
+                               labels, label_weights, bbox_targets,
+                               bbox_weights, vlr_region, im_region)
+    expected = (unmap(anchors, num_total_anchors, inside_flags),
+                unmap(labels, num_total_anchors, inside_flags,
+                      fill=num_classes),
+                unmap(label_weights, num_total_anchors, inside_flags),
+                unmap(bbox_targets, num_total_anchors, inside_flags),
+                unmap(bbox_weights, num_total_anchors, inside_flags),
+                unmap(vlr_region, num_total_anchors, inside_flags),
+                unmap(im_region, num_total_anchors, inside_flags))
+    for out, exp in zip(outs, expected):
+        assert out.shape == exp.shape
+        assert out.dtype == exp.dtype
+        assert torch.equal(out, exp)
+    # outside anchors are background
+    assert (outs[1][~inside_flags] == num_classes).all()
+
+
+def test_gfl_head_batch_inside_flags():
+    """Tests the batched inside flags against per image inside flags."""
+    train_cfg = mmcv.Config(
+        dict(
+            assigner=dict(type='ATSSAssigner', topk=9),
+            allowed_border=0,
+            pos_weight=-1,
+            debug=False))
+    self = GFLHead(
+        num_classes=4,
+        in_channels=1,
+        train_cfg=train_cfg,
+        anchor_generator=dict(
+            type='AnchorGenerator',
+            ratios=[1.0],
+            octave_base_scale=8,
+            scales_per_octave=1,
+            strides=[8, 16, 32, 64, 128]),
+        loss_cls=dict(
+            type='QualityFocalLoss',
+            use_sigmoid=True,
+            beta=2.0,
+            loss_weight=1.0),
+        loss_bbox=dict(type='GIoULoss', loss_weight=2.0))
+
+    num_level_anchors = [40, 20, 10, 5, 3]
+    num_anchors = sum(num_level_anchors)
+    img_metas = [{
+        'img_shape': (60, 80, 3)
+    }, {
+        'img_shape': (90, 50, 3)
+    }, {
+        'img_shape': (100, 100, 3)
+    }]
+    flat_anchor_list, valid_flag_list = [], []
+    for _ in img_metas:
+        xy = torch.rand(num_anchors, 2) * 120 - 10
+        wh = torch.rand(num_anchors, 2) * 40
+        flat_anchor_list.append(torch.cat([xy, xy + wh], dim=1))
+        valid_flag_list.append(torch.rand(num_anchors) > 0.2)
+
+    inside_flags_list, num_level_anchors_inside_list = \
+        self.get_batch_inside_flags(flat_anchor_list, valid_flag_list,
+                                    num_level_anchors, img_metas)
+    assert len(inside_flags_list) == len(img_metas)
+    for i, img_meta in enumerate(img_metas):
+        expected = anchor_inside_flags(flat_anchor_list[i],
+                                       valid_flag_list[i],
+                                       img_meta['img_shape'][:2],
+                                       train_cfg.allowed_border)
+        assert torch.equal(inside_flags_list[i], expected)
+        expected_counts = [
+            int(flags.sum())
+            for flags in torch.split(expected, num_level_anchors)
+        ]
+        assert num_level_anchors_inside_list[i] == expected_counts